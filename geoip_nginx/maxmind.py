@@ -0,0 +1,291 @@
+"""MaxMind GeoLite2 database downloading and querying."""
+
+import ipaddress
+import tarfile
+import zipfile
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta
+from pathlib import Path
+from types import TracebackType
+from typing import Self
+
+import maxminddb
+import numpy as np
+import requests
+from requests.auth import HTTPBasicAuth
+from rich.console import Console
+
+from geoip_nginx.network import IPNetwork
+
+console = Console()
+
+COUNTRY_CODE_LENGTH = 2
+
+DOWNLOAD_URL_COUNTRY = "https://download.maxmind.com/geoip/databases/GeoLite2-Country/download?suffix=tar.gz"
+DOWNLOAD_URL_ASN = "https://download.maxmind.com/geoip/databases/GeoLite2-ASN/download?suffix=tar.gz"
+
+DB_DIR = Path("/usr/share/GeoIP")
+DB_MAX_AGE = timedelta(days=7)
+
+REQUESTS_TIMEOUT = 10
+
+# Offset of the IPv4-mapped range (::ffff:0:0/96) in the IPv6 address space
+_V4_MAPPED_OFFSET = 0xFFFF << 32
+
+
+def _mapped_int(address: ipaddress.IPv4Address | ipaddress.IPv6Address) -> int:
+    """Map an address to its integer position in the IPv6 search tree."""
+    value = int(address)
+    return value + _V4_MAPPED_OFFSET if isinstance(address, ipaddress.IPv4Address) else value
+
+
+def _open_database(db_path: Path) -> maxminddb.Reader:
+    """Open a database with the C extension reader, falling back to pure Python."""
+    try:
+        return maxminddb.open_database(db_path, maxminddb.MODE_MMAP_EXT)
+    except (ImportError, ValueError):
+        console.log(
+            f"[yellow]maxminddb C extension unavailable, reading {db_path.name} with the much slower "
+            "pure-Python reader. Reinstall maxminddb from a binary wheel to fix this.[/]"
+        )
+        return maxminddb.open_database(db_path, maxminddb.MODE_MMAP)
+
+
+class MaxMindHandler:
+    """Download and query the GeoLite2 Country and ASN databases."""
+
+    def __init__(
+        self,
+        account_id: str,
+        license_key: str,
+        db_dir: Path = DB_DIR,
+        max_age: timedelta = DB_MAX_AGE,
+    ) -> None:
+        """Set up database paths and the freshness cutoff."""
+        self._auth = HTTPBasicAuth(account_id, license_key)
+        self.db_path_country = db_dir / "GeoLite2-Country.mmdb"
+        self.db_path_asn = db_dir / "GeoLite2-ASN.mmdb"
+        self._cutoff_ts = (datetime.now() - max_age).timestamp()
+        self._country_reader: maxminddb.Reader | None = None
+        self._asn_reader: maxminddb.Reader | None = None
+
+    @property
+    def country_reader(self) -> maxminddb.Reader:
+        """The Country database reader, opened on first use and kept open."""
+        if self._country_reader is None:
+            self._country_reader = _open_database(self.db_path_country)
+        return self._country_reader
+
+    @property
+    def asn_reader(self) -> maxminddb.Reader:
+        """The ASN database reader, opened on first use and kept open."""
+        if self._asn_reader is None:
+            self._asn_reader = _open_database(self.db_path_asn)
+        return self._asn_reader
+
+    def close(self) -> None:
+        """Close any open database readers."""
+        if self._country_reader is not None:
+            self._country_reader.close()
+            self._country_reader = None
+        if self._asn_reader is not None:
+            self._asn_reader.close()
+            self._asn_reader = None
+
+    def __enter__(self) -> Self:
+        """Enter the context manager."""
+        return self
+
+    def __exit__(
+        self,
+        exc_type: type[BaseException] | None,
+        exc_value: BaseException | None,
+        traceback: TracebackType | None,
+    ) -> None:
+        """Close the database readers on exit."""
+        self.close()
+
+    def _download_db(self, url: str, db_path: Path, mmdb_filename: str) -> bool:
+        """Download a single GeoLite2 database if it's missing or outdated."""
+        try:
+            fresh = db_path.stat().st_mtime >= self._cutoff_ts
+        except FileNotFoundError:
+            fresh = False
+
+        if fresh:
+            console.log(f"{mmdb_filename} is up to date at {db_path}. Skipping download.")
+            return True
+
+        db_path.parent.mkdir(parents=True, exist_ok=True)
+
+        with requests.get(url, auth=self._auth, stream=True, timeout=REQUESTS_TIMEOUT) as response:
+            response.raise_for_status()
+            response.raw.decode_content = True
+
+            # Streaming mode ("r|gz") doesn't allow getmembers(), so iterate the archive instead
+            with tarfile.open(fileobj=response.raw, mode="r|gz") as tar:
+                for member in tar:
+                    if member.name.endswith(mmdb_filename):
+                        member.name = Path(member.name).name
+                        tar.extract(member, path=db_path.parent)
+                        (db_path.parent / member.name).rename(db_path)
+                        return True
+
+        console.log(f"[bold red]Failed to find {mmdb_filename} in the downloaded archive.[/]")
+        return False
+
+    def download_databases(self) -> bool:
+        """Download all GeoLite2 databases, returning False if any of them failed."""
+        databases = (
+            (DOWNLOAD_URL_COUNTRY, self.db_path_country, "GeoLite2-Country.mmdb"),
+            (DOWNLOAD_URL_ASN, self.db_path_asn, "GeoLite2-ASN.mmdb"),
+        )
+        # The downloads are independent and network-bound, so overlap them
+        with ThreadPoolExecutor(max_workers=len(databases)) as executor:
+            futures = [executor.submit(self._download_db, *database) for database in databases]
+            results = [future.result() for future in futures]
+        return all(results)
+
+    def _build_country_flat(self) -> dict[str, np.ndarray]:
+        """Build the flat CIDR table by iterating the full Country database once."""
+        v4_addrs: list[int] = []
+        v4_plens: list[int] = []
+        v4_isos: list[str] = []
+        v6_addr_his: list[int] = []
+        v6_addr_los: list[int] = []
+        v6_plens: list[int] = []
+        v6_isos: list[str] = []
+
+        for network, record in self.country_reader:
+            if not record:
+                continue
+
+            iso_code = (record.get("country") or {}).get("iso_code")
+
+            if not iso_code:
+                continue
+
+            addr = int(network.network_address)
+            if isinstance(network, ipaddress.IPv4Network):
+                v4_addrs.append(addr)
+                v4_plens.append(network.prefixlen)
+                v4_isos.append(iso_code)
+            else:
+                v6_addr_his.append(addr >> 64)
+                v6_addr_los.append(addr & ((1 << 64) - 1))
+                v6_plens.append(network.prefixlen)
+                v6_isos.append(iso_code)
+
+        return {
+            "v4_addrs": np.array(v4_addrs, dtype=np.uint32),
+            "v4_plens": np.array(v4_plens, dtype=np.uint8),
+            "v4_isos": np.array(v4_isos, dtype="S2"),
+            "v6_addr_his": np.array(v6_addr_his, dtype=np.uint64),
+            "v6_addr_los": np.array(v6_addr_los, dtype=np.uint64),
+            "v6_plens": np.array(v6_plens, dtype=np.uint8),
+            "v6_isos": np.array(v6_isos, dtype="S2"),
+        }
+
+    def _load_country_flat(self) -> dict[str, np.ndarray]:
+        """Load the flat CIDR table, rebuilding and caching it when the database is newer."""
+        cache_path = self.db_path_country.with_suffix(".flat.npz")
+        db_mtime = self.db_path_country.stat().st_mtime
+
+        try:
+            if cache_path.stat().st_mtime >= db_mtime:
+                with np.load(cache_path) as data:
+                    return {key: data[key] for key in data.files}
+        except (OSError, ValueError, zipfile.BadZipFile):
+            # Missing or unreadable (e.g. truncated by a crash mid-write) cache, rebuild it
+            pass
+
+        arrays = self._build_country_flat()
+
+        # Write via a temp file so a crash can't leave a fresh-looking but truncated cache
+        tmp_path = cache_path.with_suffix(".npz.tmp")
+        with tmp_path.open("wb") as f:
+            np.savez_compressed(f, **arrays)
+        tmp_path.replace(cache_path)
+
+        return arrays
+
+    def _log_found_asns(self, ranges: list[IPNetwork]) -> None:
+        """Log how many ASNs the given ranges fall in, via a merged walk of the ASN database."""
+        found_asns: dict[int, str] = {}
+
+        asn_iter = iter(self.asn_reader)
+        asn_net, asn_record = next(asn_iter, (None, None))
+
+        # The ASN reader yields networks in address order, so advance its cursor
+        # in lockstep over the sorted ranges instead of re-descending its tree
+        for network in sorted(ranges, key=lambda net: _mapped_int(net.network_address)):
+            address = _mapped_int(network.network_address)
+            while asn_net is not None and _mapped_int(asn_net.broadcast_address) < address:
+                asn_net, asn_record = next(asn_iter, (None, None))
+
+            if asn_net is not None and asn_record and _mapped_int(asn_net.network_address) <= address:
+                asn_number = asn_record.get("autonomous_system_number")
+                if asn_number is not None and asn_number not in found_asns:
+                    found_asns[asn_number] = asn_record.get("autonomous_system_organization", "")
+
+        console.log(f"Matched ranges span {len(found_asns)} ASNs.")
+
+    def get_country_ip_ranges(self, country_codes: list[str]) -> list[IPNetwork]:
+        """Get IP ranges for the given country codes from the GeoLite2 Country database.
+
+        Queries a flat table cached on disk next to the database, so only the
+        first run after a database refresh pays for the full iteration. Also
+        logs the ASNs the matched ranges fall in.
+        """
+        wanted = set()
+        for country_code in country_codes:
+            if len(country_code) != COUNTRY_CODE_LENGTH or not country_code.isascii():
+                console.log(f"[bold red]Invalid country code: {country_code}. Must be a 2-letter ISO code.[/]")
+                continue
+            wanted.add(country_code.upper())
+
+        wanted_isos = np.array(sorted(wanted), dtype="S2")
+
+        flat = self._load_country_flat()
+
+        ranges: list[IPNetwork] = []
+
+        v4_mask = np.isin(flat["v4_isos"], wanted_isos)
+        ranges.extend(
+            ipaddress.IPv4Network((int(addr), int(plen)))
+            for addr, plen in zip(flat["v4_addrs"][v4_mask], flat["v4_plens"][v4_mask], strict=True)
+        )
+
+        v6_mask = np.isin(flat["v6_isos"], wanted_isos)
+        ranges.extend(
+            ipaddress.IPv6Network(((int(addr_hi) << 64) | int(addr_lo), int(plen)))
+            for addr_hi, addr_lo, plen in zip(
+                flat["v6_addr_his"][v6_mask],
+                flat["v6_addr_los"][v6_mask],
+                flat["v6_plens"][v6_mask],
+                strict=True,
+            )
+        )
+
+        self._log_found_asns(ranges)
+
+        return ranges
+
+    def get_country_ip_range_strings(self, country_codes: list[str]) -> list[str]:
+        """Get IP ranges for the given country codes as CIDR strings."""
+        return [str(network) for network in self.get_country_ip_ranges(country_codes)]
+
+    def get_asn_ip_ranges(self, asn_numbers: list[int]) -> list[IPNetwork]:
+        """Get IP ranges for the given ASNs from the GeoLite2 ASN database."""
+        if not asn_numbers:
+            return []
+
+        wanted = frozenset(asn_numbers)
+
+        ranges: list[IPNetwork] = []
+        for network, record in self.asn_reader:
+            asn_number = record.get("autonomous_system_number") if record else None
+            if asn_number in wanted:
+                ranges.append(network)
+
+        return ranges
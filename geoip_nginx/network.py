@@ -1,86 +1,259 @@
 """Network optimization utilities for IP range management."""
 
 import ipaddress
+import itertools
+from typing import NamedTuple
 
+import numpy as np
 from rich.console import Console
-from tqdm import tqdm
+
+try:
+    from numba import njit
+except ImportError:
+    njit = None
 
 console = Console()
 
 DEFAULT_COVERAGE_THRESHOLD = 0.9
 
+SINGLE_CHILD_COVERAGE = 0.5  # A lone child always covers exactly half of its parent
+
 IPNetwork = ipaddress.IPv4Network | ipaddress.IPv6Network
 
 
-def _calculate_coverage(
-    parent_net: IPNetwork,
-    child_networks: list[IPNetwork],
-) -> float:
-    """Calculate what percentage of parent network is covered by child networks."""
-    parent_size = parent_net.num_addresses
-    covered_addresses = sum(net.num_addresses for net in child_networks if net.subnet_of(parent_net))
+class _FastNet(NamedTuple):
+    """Integer form of a network, so containment checks are plain bitmask tests."""
+
+    addr: int
+    prefixlen: int
+    mask: int
+    size: int
+
+
+def _fast_net(addr: int, prefixlen: int, bits: int) -> _FastNet:
+    """Build a _FastNet from an integer address and prefix length."""
+    size = 1 << (bits - prefixlen)
+    mask = ((1 << bits) - 1) ^ (size - 1)
+    return _FastNet(addr, prefixlen, mask, size)
+
+
+def _calculate_coverage(parent_size: int, covered_addresses: int) -> float:
+    """Calculate what fraction of a parent network the covered addresses represent."""
     return covered_addresses / parent_size
 
 
-def _optimize_networks(
+def _range_to_cidrs(lo: int, hi: int, bits: int) -> list[tuple[int, int]]:
+    """Split an inclusive integer address range into minimal (address, prefix length) CIDRs."""
+    cidrs: list[tuple[int, int]] = []
+    while lo <= hi:
+        alignment = lo & -lo if lo else 1 << bits
+        block = min(alignment, 1 << ((hi - lo + 1).bit_length() - 1))
+        cidrs.append((lo, bits - block.bit_length() + 1))
+        lo += block
+    return cidrs
+
+
+def _coalesce_v4(networks: list[ipaddress.IPv4Network]) -> list[ipaddress.IPv4Network]:
+    """Coalesce IPv4 networks with vectorized integer-range arithmetic.
+
+    Converts each network to an inclusive (start, end) integer range, merges
+    overlapping or adjacent ranges in bulk, then splits the merged ranges back
+    into minimal CIDRs. Equivalent to _coalesce but without per-object work.
+    """
+    if len(networks) == 0:
+        console.print("No networks to coalesce.")
+        return []
+
+    starts = np.fromiter((int(net.network_address) for net in networks), dtype=np.uint64, count=len(networks))
+    sizes = np.fromiter((net.num_addresses for net in networks), dtype=np.uint64, count=len(networks))
+    ends = starts + sizes - 1
+
+    order = np.lexsort((ends, starts))
+    starts = starts[order]
+    ends = np.maximum.accumulate(ends[order])
+
+    # A merged range begins wherever a start isn't covered by (or adjacent to) the running end
+    new_range = np.empty(len(starts), dtype=bool)
+    new_range[0] = True
+    new_range[1:] = starts[1:] > ends[:-1] + 1
+
+    range_starts = starts[new_range]
+    range_ends = np.append(ends[np.flatnonzero(new_range)[1:] - 1], ends[-1])
+
+    bits = 32
+    return [
+        ipaddress.IPv4Network((addr, prefixlen))
+        for lo, hi in zip(range_starts, range_ends, strict=True)
+        for addr, prefixlen in _range_to_cidrs(int(lo), int(hi), bits)
+    ]
+
+
+def _coverage_threshold_kernel(
+    addrs: np.ndarray,
+    plens: np.ndarray,
+    bits: int,
+    coverage_threshold: float,
+) -> tuple[np.ndarray, np.ndarray]:
+    """Coverage-threshold sweep over parallel int64 (address, prefix length) arrays.
+
+    Written in numeric-only style so Numba can compile it when installed;
+    without Numba it runs as-is on the NumPy arrays.
+    """
+    n = addrs.shape[0]
+    out_addrs = np.empty(n, np.int64)
+    out_plens = np.empty(n, np.int64)
+    count = 0
+    i = 0
+
+    while i < n:
+        addr = addrs[i]
+        plen = plens[i]
+
+        if plen == 0:
+            out_addrs[count] = addr
+            out_plens[count] = plen
+            count += 1
+            i += 1
+            continue
+
+        parent_plen = plen - 1
+        parent_size = 1 << (bits - parent_plen)
+        parent_addr = addr & ~(parent_size - 1)
+        covered_addresses = 1 << (bits - plen)
+        j = i + 1
+        while j < n and plens[j] >= parent_plen and addrs[j] & ~(parent_size - 1) == parent_addr:
+            covered_addresses += 1 << (bits - plens[j])
+            j += 1
+
+        if covered_addresses / parent_size >= coverage_threshold:
+            out_addrs[count] = parent_addr
+            out_plens[count] = parent_plen
+            count += 1
+            i = j
+        else:
+            out_addrs[count] = addr
+            out_plens[count] = plen
+            count += 1
+            i += 1
+
+    return out_addrs[:count], out_plens[:count]
+
+
+if njit is not None:
+    _coverage_threshold_kernel = njit(cache=True)(_coverage_threshold_kernel)
+
+
+def _apply_coverage_threshold(
     networks: list[ipaddress.IPv4Network] | list[ipaddress.IPv6Network],
+    coverage_threshold: float,
 ) -> list[ipaddress.IPv4Network] | list[ipaddress.IPv6Network]:
-    """Optimize a list of networks by merging based on coverage."""
-    optimised: list[ipaddress.IPv4Network] | list[ipaddress.IPv6Network] = []
-    i = 0
+    """Replace runs of subnets with their parent when coverage is high enough.
 
+    Input must be sorted and disjoint (i.e. already coalesced), so the subnets
+    of any candidate parent form a consecutive run. IPv4 networks go through
+    the array kernel (Numba-compiled when available); IPv6 networks are
+    converted to _FastNet once so the loop is integer comparisons rather than
+    ipaddress method calls. Only the output is materialized as network objects.
+    """
     if len(networks) == 0:
-        console.print("No networks to optimize.")
-        return optimised
+        return []
 
-    network_type = "IPv4" if isinstance(networks[0], ipaddress.IPv4Network) else "IPv6"
+    bits = networks[0].max_prefixlen
+    network_cls = type(networks[0])
 
-    with tqdm(total=len(networks), desc=f"Optimizing {network_type} networks") as pbar:
-        while i < len(networks):
-            current = networks[i]
+    if isinstance(networks[0], ipaddress.IPv4Network):
+        addrs = np.fromiter((int(net.network_address) for net in networks), dtype=np.int64, count=len(networks))
+        plens = np.fromiter((net.prefixlen for net in networks), dtype=np.int64, count=len(networks))
+        out_addrs, out_plens = _coverage_threshold_kernel(addrs, plens, bits, coverage_threshold)
+        return [network_cls((int(addr), int(plen))) for addr, plen in zip(out_addrs, out_plens, strict=True)]
 
-            # For networks with prefix length > 0, check if we should expand to parent
-            if current.prefixlen > 0:
-                # Get the parent network (one bit shorter prefix)
-                parent = current.supernet(prefixlen_diff=1)
+    # IPv6 addresses don't fit a fixed-width integer dtype, so keep the Python loop
+    fast_nets = [_fast_net(int(net.network_address), net.prefixlen, bits) for net in networks]
 
-                # Find all networks that would be children of this parent
-                potential_children = [net for net in networks if net.subnet_of(parent) or net == parent]
+    optimised: list[_FastNet] = []
+    i = 0
+
+    while i < len(fast_nets):
+        current = fast_nets[i]
 
-                # Calculate coverage
-                coverage = _calculate_coverage(parent, potential_children)
+        if current.prefixlen == 0:
+            optimised.append(current)
+            i += 1
+            continue
 
-                if coverage >= coverage_threshold:
-                    # Skip all the children, add the parent instead
-                    # console.print(
-                    #     f"Merging {len(potential_children)} subnets into {parent} (coverage: {coverage:.1%})"
-                    # )
-                    optimised.append(parent)
-                    # Find the next network after all children of this parent
-                    start_i = i
-                    i += 1
-                    while i < len(networks) and (networks[i].subnet_of(parent) or networks[i] == parent):
-                        i += 1
-                    pbar.update(i - start_i)
-                    continue
+        parent = _fast_net(current.addr & (current.mask << 1), current.prefixlen - 1, bits)
+        covered_addresses = current.size
+        j = i + 1
+        while (
+            j < len(fast_nets)
+            and fast_nets[j].prefixlen >= parent.prefixlen
+            and fast_nets[j].addr & parent.mask == parent.addr
+        ):
+            covered_addresses += fast_nets[j].size
+            j += 1
+
+        if _calculate_coverage(parent.size, covered_addresses) >= coverage_threshold:
+            optimised.append(parent)
+            i = j
+        else:
+            optimised.append(current)
+            i += 1
 
-                # Check if this network is a subset of any already kept network
-                is_subset = False
-                for kept_network in optimised:
-                    if current.subnet_of(kept_network):
-                        is_subset = True
-                        break
+    return [network_cls((net.addr, net.prefixlen)) for net in optimised]
 
-                if not is_subset:
-                    optimised.append(current)
 
-                i += 1
-                pbar.update(1)
+def _has_merge_candidates(
+    pairs: tuple[tuple[int, int], ...],
+    bits: int,
+    coverage_threshold: float,
+) -> bool:
+    """Check whether any consecutive pair of (address, prefix length) shares a candidate parent.
+
+    The coverage pass only merges runs that start with two networks under one
+    parent (unless the threshold allows a lone half-covering child), so when no
+    such pair exists the pass cannot change anything.
+    """
+    if coverage_threshold <= SINGLE_CHILD_COVERAGE:
+        return True
+
+    for (addr_a, plen_a), (addr_b, plen_b) in itertools.pairwise(pairs):
+        if plen_a == 0:
+            continue
+        shift = bits - (plen_a - 1)
+        if plen_b >= plen_a - 1 and addr_a >> shift == addr_b >> shift:
+            return True
 
-        return optimised
+    return False
 
 
-def merge_ip_ranges(ip_ranges: list[str], coverage_threshold: float = DEFAULT_COVERAGE_THRESHOLD) -> list[str]:
+def _optimize_until_stable(
+    networks: list[ipaddress.IPv4Network] | list[ipaddress.IPv6Network],
+    coverage_threshold: float,
+) -> list[ipaddress.IPv4Network] | list[ipaddress.IPv6Network]:
+    """Apply the coverage pass until a fixed point.
+
+    A merge can create a parent that is itself mergeable with its sibling, so
+    the pass repeats until the (address, prefix length) tuples stop changing -
+    comparing content rather than length, since a merge can leave the count
+    unchanged. The prescan skips the pass when no merge is possible.
+    """
+    if len(networks) == 0:
+        return []
+
+    bits = networks[0].max_prefixlen
+
+    previous = tuple((int(net.network_address), net.prefixlen) for net in networks)
+    while True:
+        if not _has_merge_candidates(previous, bits, coverage_threshold):
+            return networks
+        networks = _apply_coverage_threshold(networks, coverage_threshold)
+        current = tuple((int(net.network_address), net.prefixlen) for net in networks)
+        if current == previous:
+            return networks
+        previous = current
+
+
+def merge_ip_ranges(ip_ranges: list[IPNetwork], coverage_threshold: float = DEFAULT_COVERAGE_THRESHOLD) -> list[str]:
     """Merge overlapping or contiguous IP ranges, removing subsets.
 
     If coverage_threshold or more of a parent network is covered by smaller subnets,
@@ -88,37 +261,19 @@ def merge_ip_ranges(ip_ranges: list[str], coverage_threshold: float = DEFAULT_CO
     """
     console.print("Length before merge: ", len(ip_ranges))
 
-    # Convert to network objects
+    # Split by address family, keeping the network objects as-is
     networks_v4: list[ipaddress.IPv4Network] = []
     networks_v6: list[ipaddress.IPv6Network] = []
-    for ip_range in ip_ranges:
-        net = ipaddress.ip_network(ip_range)
+    for net in ip_ranges:
         if isinstance(net, ipaddress.IPv4Network):
             networks_v4.append(net)
         else:
             networks_v6.append(net)
 
-    # Sort by network address and prefix length (shorter prefix = larger network first)
-    networks_v4.sort(key=lambda net: (net.network_address, net.prefixlen))
-    networks_v6.sort(key=lambda net: (net.network_address, net.prefixlen))
-
-    n_round = 0
-    while True:
-        n_round += 1
-        console.print(f"Optimization round {n_round}...")
-        prev_len_v4 = len(networks_v4)
-        networks_v4 = _optimize_networks(networks_v4)
-        if len(networks_v4) == prev_len_v4:
-            break
-
-    n_round = 0
-    while True:
-        n_round += 1
-        console.print(f"Optimization round {n_round}...")
-        prev_len_v6 = len(networks_v6)
-        networks_v6 = _optimize_networks(networks_v6)
-        if len(networks_v6) == prev_len_v6:
-            break
+    # collapse_addresses merges exact overlaps and adjacent siblings and returns
+    # sorted disjoint networks, which is what the coverage pass expects
+    networks_v4 = _optimize_until_stable(_coalesce_v4(networks_v4), coverage_threshold)
+    networks_v6 = _optimize_until_stable(list(ipaddress.collapse_addresses(networks_v6)), coverage_threshold)
 
     console.print("Length after optimization: ", len(networks_v4) + len(networks_v6))
     return [str(net) for net in networks_v4] + [str(net) for net in networks_v6]